@@ -28,6 +28,12 @@ class Settings(BaseSettings):
     gmail_oauth_scope: str = "https://mail.google.com/"
     gmail_token_uri: str = "https://oauth2.googleapis.com/token"
 
+    # Quantidade de mensagens buscadas por comando FETCH (lotes)
+    fetch_batch_size: int = 100
+
+    # Conexões IMAP simultâneas para download dos corpos (Gmail aceita ~15)
+    fetch_parallel_connections: int = 4
+
     model_config = SettingsConfigDict(
         env_file=".env",
         env_file_encoding="utf-8",
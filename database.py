@@ -1,12 +1,63 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 from .config import settings
 
 engine = create_engine(
     settings.database_url,
     connect_args={"check_same_thread": False} if settings.database_url.startswith("sqlite") else {},
+    pool_pre_ping=True,
+    # Cache de compilação SQL -> string maior que o default (500): os
+    # statements quentes dos repositórios nunca são recompilados
+    query_cache_size=1200,
 )
 
+if settings.database_url.startswith("sqlite"):
+    # WAL permite leituras da API durante o burst de INSERTs do job e
+    # reduz fsyncs por commit; demais pragmas são a receita padrão de
+    # SQLite em produção.
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        dbapi_connection.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "PRAGMA temp_store=MEMORY;"
+            "PRAGMA mmap_size=268435456;"
+            "PRAGMA cache_size=-65536;"
+        )
+
+def _ensure_schema_migrations():
+    """ Migrações leves para bases criadas antes de colunas novas: o create_all só cria tabelas que faltam, nunca altera as existentes. Hoje cobre email_filters.updated_at (usado pelo cache de filtros). """
+    if not settings.database_url.startswith("sqlite"):
+        # Em outros bancos a migração fica a cargo do deploy:
+        #   ALTER TABLE email_filters ADD COLUMN updated_at TIMESTAMP;
+        #   UPDATE email_filters SET updated_at = created_at;
+        return
+    with engine.connect() as conn:
+        tables = {
+            row[0]
+            for row in conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type='table'"
+            )
+        }
+        if "email_filters" not in tables:
+            return  # o create_all cria a tabela já com a coluna
+        columns = {
+            row[1]
+            for row in conn.exec_driver_sql("PRAGMA table_info(email_filters)")
+        }
+        if "updated_at" not in columns:
+            conn.exec_driver_sql(
+                "ALTER TABLE email_filters ADD COLUMN updated_at DATETIME"
+            )
+            conn.exec_driver_sql(
+                "UPDATE email_filters"
+                " SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP)"
+            )
+            conn.commit()
+
+
+_ensure_schema_migrations()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
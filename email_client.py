@@ -1,9 +1,36 @@
 import email
+import email.policy
 import imaplib
-from typing import List, Dict, Any
+import os
+import tempfile
+from typing import Iterator, List, Dict, Any, Optional
 from datetime import datetime
+from functools import lru_cache
 from .config import settings
 from email.header import decode_header, make_header
+from email.utils import parsedate_to_datetime
+
+# Diretório de anexos garantido uma vez no import — os payloads são
+# spoolados aqui em temporários, sem um makedirs (stat) por anexo
+os.makedirs(settings.attachments_dir, exist_ok=True)
+
+
+@lru_cache(maxsize=4096)
+def parse_date_header(date_raw: str) -> Optional[datetime]:
+    """ Converte o cabeçalho Date em datetime, com cache — mensagens do mesmo lote frequentemente repetem o valor. Retorna None se inválido. """
+    try:
+        return parsedate_to_datetime(date_raw)
+    except Exception:
+        return None
+
+
+def fast_decode_header(value):
+    """ Decodifica um cabeçalho RFC 2047 apenas quando necessário: sem encoded-word ("=?") a string volta como está — o caso comum (ASCII puro) não paga o custo do decode_header. """
+    if not value:
+        return value
+    if "=?" not in value:
+        return value
+    return str(make_header(decode_header(value)))
 
 
 class EmailClient:
@@ -24,90 +51,94 @@ class EmailClient:
         mail.login(self.user, self.password)
         return mail
 
-    def fetch_unseen_emails_raw(self) -> List[Dict[str, Any]]:
-        """ Exemplo: busca todos os emails recentes. Você pode refinar para buscar por data ou por flag 'UNSEEN'. """
+    @staticmethod
+    def _parse_message(raw_bytes: bytes) -> Dict[str, Any]:
+        """ Converte uma mensagem crua no dict consumido pelo pipeline de persistência (headers decodificados, corpo texto e anexos). O payload de cada anexo vai direto para um arquivo temporário no diretório de anexos ('path'), em vez de viajar como bytes. """
+        msg = email.message_from_bytes(raw_bytes, policy=email.policy.default)
+
+        message_id = msg.get("Message-ID", "").strip()
+        sender = fast_decode_header(msg.get("From", ""))
+        recipient = fast_decode_header(msg.get("To", ""))
+        cc = fast_decode_header(msg.get("Cc"))
+        subject = fast_decode_header(msg.get("Subject"))
+        date_raw = msg.get("Date")
+        received_at = parse_date_header(str(date_raw)) if date_raw else None
+
+        # Corpo: get_body curto-circuita a travessia das partes
+        body_text = ""
+        body_part = msg.get_body(preferencelist=("plain",))
+        if body_part is not None:
+            try:
+                body_text = body_part.get_content()
+            except Exception:
+                payload = body_part.get_payload(decode=True)
+                if payload:
+                    charset = body_part.get_content_charset() or "utf-8"
+                    body_text = payload.decode(charset, errors="replace")
+
+        # Anexos: iter_attachments pula as partes de texto
+        attachments = []
+        if msg.is_multipart():
+            for part in msg.iter_attachments():
+                filename = part.get_filename()
+                if filename:
+                    filename_decoded = fast_decode_header(filename)
+                else:
+                    filename_decoded = "unknown"
+                payload = part.get_payload(decode=True) or b""
+                # Temp no mesmo diretório do destino final: o os.replace
+                # da persistência fica atômico (mesmo filesystem) e o
+                # payload decodificado não se acumula em memória
+                with tempfile.NamedTemporaryFile(
+                    delete=False, dir=settings.attachments_dir, prefix=".tmp-attach-"
+                ) as tmp:
+                    tmp.write(payload)
+                attachments.append(
+                    {
+                        "filename": filename_decoded,
+                        "mime_type": part.get_content_type(),
+                        "path": tmp.name,
+                        "size_bytes": len(payload),
+                    }
+                )
+
+        return {
+            "message_id": message_id,
+            "sender": sender,
+            "recipient": recipient,
+            "cc": cc,
+            "subject": subject,
+            "body": body_text,
+            "received_at": received_at,
+            "attachments": attachments,
+        }
+
+    def iter_unseen_emails(self, batch_size: int = 50) -> Iterator[List[Dict[str, Any]]]:
+        """ Gera os emails em lotes de batch_size: o pico de memória fica limitado a um lote (corpos + anexos), em vez da caixa inteira. """
         mail = self._connect()
         try:
             mail.select("INBOX")
             # Buscar todos: "ALL" ou somente não lidos: "UNSEEN"
             status, messages = mail.search(None, "ALL")
             if status != "OK":
-                return []
+                return
 
             email_ids = messages[0].split()
-            result = []
-            for num in email_ids:
-                status, data = mail.fetch(num, "(RFC822)")
-                if status != "OK":
-                    continue
-                msg = email.message_from_bytes(data[0][1])
-
-                message_id = msg.get("Message-ID", "").strip()
-                sender = str(make_header(decode_header(msg.get("From", ""))))
-                recipient = str(make_header(decode_header(msg.get("To", ""))))
-                cc = str(make_header(decode_header(msg.get("Cc", "")))) if msg.get("Cc") else None
-                subject = str(make_header(decode_header(msg.get("Subject", "")))) if msg.get("Subject") else None
-                date_raw = msg.get("Date")
-                try:
-                    received_at = datetime.fromtimestamp(email.utils.mktime_tz(email.utils.parsedate_tz(date_raw)))
-                except Exception:
-                    received_at = None
-
-                # Corpo
-                body_text = ""
-                attachments = []
-                if msg.is_multipart():
-                    for part in msg.walk():
-                        content_disposition = str(part.get("Content-Disposition", ""))
-                        content_type = part.get_content_type()
-                        if "attachment" in content_disposition.lower():
-                            filename = part.get_filename()
-                            if filename:
-                                filename_decoded = str(make_header(decode_header(filename)))
-                            else:
-                                filename_decoded = "unknown"
-                            payload = part.get_payload(decode=True) or b""
-                            attachments.append(
-                                {
-                                    "filename": filename_decoded,
-                                    "mime_type": content_type,
-                                    "content": payload,
-                                    "size_bytes": len(payload),
-                                }
-                            )
-                        elif content_type == "text/plain" and "attachment" not in content_disposition.lower():
-                            payload = part.get_payload(decode=True)
-                            if payload:
-                                charset = part.get_content_charset() or "utf-8"
-                                try:
-                                    body_text += payload.decode(charset, errors="replace")
-                                except Exception:
-                                    body_text += payload.decode(errors="replace")
-                else:
-                    if msg.get_content_type() == "text/plain":
-                        payload = msg.get_payload(decode=True)
-                        charset = msg.get_content_charset() or "utf-8"
-                        if payload:
-                            try:
-                                body_text = payload.decode(charset, errors="replace")
-                            except Exception:
-                                body_text = payload.decode(errors="replace")
-
-                result.append(
-                    {
-                        "message_id": message_id,
-                        "sender": sender,
-                        "recipient": recipient,
-                        "cc": cc,
-                        "subject": subject,
-                        "body": body_text,
-                        "received_at": received_at,
-                        "attachments": attachments,
-                    }
-                )
-            return result
+            for start in range(0, len(email_ids), batch_size):
+                chunk = []
+                for num in email_ids[start:start + batch_size]:
+                    status, data = mail.fetch(num, "(RFC822)")
+                    if status != "OK":
+                        continue
+                    chunk.append(self._parse_message(data[0][1]))
+                if chunk:
+                    yield chunk
         finally:
             try:
                 mail.logout()
             except Exception:
-                pass
\ No newline at end of file
+                pass
+
+    def fetch_unseen_emails_raw(self) -> List[Dict[str, Any]]:
+        """ Variante materializada de iter_unseen_emails, mantida para quem precisa da lista completa. """
+        return [em for chunk in self.iter_unseen_emails() for em in chunk]
\ No newline at end of file
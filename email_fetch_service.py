@@ -1,48 +1,214 @@
 # app/email_fetch_service.py
+import binascii
 import email
+import email.policy
 import logging
 import os
+import quopri
+import uuid
+from email.parser import BytesHeaderParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
 from typing import Optional, Dict, Any
 
+from sqlalchemy import delete
 from sqlalchemy.orm import Session
 
+from app import models
+from app.email_client import parse_date_header
 from app.gmail_oauth_service import GmailOAuthService
 from app.repositories import (
     EmailRepository,
-    AttachmentRepository,
     EmailFilterRepository,
     JobRunRepository,
 )
 from app.config import settings
+from app.services import apply_filters_to_email
 
 logger = logging.getLogger(__name__)
 
+# Bytes de whitespace removidos do payload base64 antes do decode
+_B64_JUNK = b"\r\n \t"
+
+# Diretório de anexos: resolvido e garantido uma vez por processo, em vez
+# de um makedirs (stat) a cada instância do serviço
+ATTACH_DIR = Path(settings.attachments_dir)
+os.makedirs(ATTACH_DIR, exist_ok=True)
+
+
+def _quote_criterion(value: str) -> str:
+    """ Quota um literal de busca IMAP (o imaplib não faz quoting sozinho). """
+    value = value.replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{value}"'
+
+
+@lru_cache(maxsize=64)
+def _compile_search_criteria( sender: Optional[str], subject: Optional[str], keyword: Optional[str], ) -> tuple:
+    """ Compila (e memoiza) a tupla de critérios de busca IMAP para uma combinação de filtros dinâmicos. """
+    parts = ["UNSEEN"]
+    if sender:
+        parts += ["FROM", _quote_criterion(sender)]
+    if subject:
+        parts += ["SUBJECT", _quote_criterion(subject)]
+    if keyword:
+        parts += ["TEXT", _quote_criterion(keyword)]
+    return tuple(parts)
+
+
+def _filters_to_imap_criteria(filters) -> Optional[str]:
+    """ Traduz os filtros dinâmicos habilitados em um pré-filtro server-side: OR entre filtros, AND (FROM/SUBJECT) dentro de cada um — o servidor já devolve só os candidatos, sem transferir corpos que seriam descartados. body_contains fica de fora (avaliado em Python sobre o conjunto menor). Filtro sem FROM/SUBJECT pode casar qualquer mensagem: nesse caso o pré-filtro é desligado (retorna None). """
+    terms = []
+    for f in filters:
+        parts = []
+        if f.from_address:
+            parts += ["FROM", _quote_criterion(f.from_address)]
+        if f.subject_contains:
+            parts += ["SUBJECT", _quote_criterion(f.subject_contains)]
+        if not parts:
+            return None
+        terms.append("(" + " ".join(parts) + ")")
+    if not terms:
+        return None
+    tree = terms[0]
+    for term in terms[1:]:
+        tree = f"(OR {tree} {term})"
+    return tree
+
 
 class EmailFetchService:
     """ Serviço responsável por: - Conectar no Gmail via IMAP OAuth2 - Buscar emails novos - Aplicar filtros dinâmicos - Salvar emails e anexos no banco + filesystem - Registrar execução em JobRun """
 
     def __init__(self, gmail_oauth_service: GmailOAuthService):
         self.gmail_oauth_service = gmail_oauth_service
-        os.makedirs(settings.attachments_dir, exist_ok=True)
 
-    def _build_search_criteria(self, dynamic_filters: Optional[Dict[str, Any]] = None) -> str:
-        """ Monta a string de busca IMAP com base em filtros dinâmicos e filtros da base. """
-        criteria_parts = ["UNSEEN"]
+    def _build_search_criteria(self, dynamic_filters: Optional[Dict[str, Any]] = None) -> tuple:
+        """ Monta a tupla de critérios de busca IMAP com base em filtros dinâmicos. Cada critério/valor vira um argumento separado do SEARCH, com quoting próprio — o split() antigo quebrava valores com espaço ('FROM "foo bar"' virava ['FROM', '\"foo', 'bar\"']). """
+        dynamic_filters = dynamic_filters or {}
+        return _compile_search_criteria(
+            dynamic_filters.get("sender"),
+            dynamic_filters.get("subject"),
+            dynamic_filters.get("keyword"),
+        )
+
+    def _fetch_raw_messages(self, imap, message_nums, items="(BODY.PEEK[])"):
+        """ Faz FETCH das mensagens em lotes (settings.fetch_batch_size por comando), evitando um round-trip IMAP por mensagem. Gera pares (num, payload bruto). Usa BODY.PEEK para não marcar as mensagens como \\Seen (mantém coerência com o critério UNSEEN da busca). """
+        batch_size = settings.fetch_batch_size
+        for start in range(0, len(message_nums), batch_size):
+            chunk = message_nums[start:start + batch_size]
+            msg_set = b",".join(chunk)
+            typ, msg_data = imap.fetch(msg_set, items)
+            if typ != "OK":
+                logger.warning("Erro ao fazer fetch do lote %s: %s", msg_set, typ)
+                continue
 
-        if dynamic_filters:
-            sender = dynamic_filters.get("sender")
-            subject = dynamic_filters.get("subject")
-            keyword = dynamic_filters.get("keyword")
+            # A resposta intercala tuplas (cabeçalho do fetch, payload)
+            # com strings de fechamento — só as tuplas interessam.
+            for item in msg_data:
+                if not isinstance(item, tuple) or len(item) < 2:
+                    continue
+                num = item[0].split(None, 1)[0]
+                yield num, item[1]
 
-            if sender:
-                criteria_parts.append(f'FROM "{sender}"')
-            if subject:
-                criteria_parts.append(f'SUBJECT "{subject}"')
-            if keyword:
-                criteria_parts.append(f'TEXT "{keyword}"')
+    def _fetch_bodies_parallel(self, message_nums):
+        """ Divide as mensagens em K fatias (settings.fetch_parallel_connections) e baixa cada fatia em uma conexão IMAP própria, em paralelo. O token OAuth cacheado é compartilhado entre as conexões. Devolve a lista de pares (num, payload) para a thread principal, que faz as escritas no banco (a Session do SQLAlchemy não é thread-safe). """
+        workers = min(settings.fetch_parallel_connections, len(message_nums))
 
-        return " ".join(criteria_parts)
+        def _fetch_slice(nums):
+            imap = self.gmail_oauth_service.open_imap_connection()
+            try:
+                typ, _ = imap.select("INBOX")
+                if typ != "OK":
+                    logger.warning("Worker não conseguiu selecionar INBOX: %s", typ)
+                    return []
+                return list(self._fetch_raw_messages(imap, nums))
+            finally:
+                try:
+                    imap.close()
+                except Exception:
+                    pass
+                try:
+                    imap.logout()
+                except Exception:
+                    pass
+
+        chunk_len = -(-len(message_nums) // workers)  # teto da divisão
+        slices = [
+            message_nums[i:i + chunk_len]
+            for i in range(0, len(message_nums), chunk_len)
+        ]
+        results = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for fetched in pool.map(_fetch_slice, slices):
+                results.extend(fetched)
+        return results
+
+    @staticmethod
+    def _write_attachment_payload(part, fh, chunk_size=64 * 1024):
+        """ Grava o payload da parte no arquivo decodificando em blocos, sem materializar os bytes decodificados inteiros em RAM (relevante para anexos grandes). Base64 vai direto pelo binascii (módulo C, sem o dispatch do get_payload); quoted-printable cai no quopri. Retorna o total de bytes gravados. """
+        cte = (part.get("Content-Transfer-Encoding") or "").strip().lower()
+        if cte == "base64":
+            raw = part.get_payload(decode=False).encode("ascii", "ignore")
+            raw = raw.translate(None, _B64_JUNK)
+            total = 0
+            # Blocos múltiplos de 4 chars decodificam de forma independente
+            step = (chunk_size // 3) * 4
+            for i in range(0, len(raw), step):
+                decoded = binascii.a2b_base64(raw[i:i + step])
+                fh.write(decoded)
+                total += len(decoded)
+            return total
+
+        if cte == "quoted-printable":
+            data = quopri.decodestring(
+                part.get_payload(decode=False).encode("ascii", "ignore")
+            )
+            fh.write(data)
+            return len(data)
+
+        data = part.get_payload(decode=True) or b""
+        fh.write(data)
+        return len(data)
+
+    def _bulk_persist(self, db: Session, emails_to_insert, attachments_pending):
+        """ Persiste emails e anexos em dois lotes executemany (em vez de um INSERT + flush por linha) e só então grava os anexos em disco, usando os PKs já atribuídos para montar o nome final. """
+        if not emails_to_insert:
+            return
+
+        db.bulk_save_objects(emails_to_insert, return_defaults=True)
+
+        attachment_objs = []
+        for email_record, attachment, _ in attachments_pending:
+            attachment.email_id = email_record.id
+            attachment_objs.append(attachment)
+        if not attachment_objs:
+            return
+        db.bulk_save_objects(attachment_objs, return_defaults=True)
+
+        rename_mappings = []
+        for email_record, attachment, part in attachments_pending:
+            stored_name = (
+                f"ID{email_record.id:08d}-{attachment.id:08d}-{attachment.filename_original}"
+            )
+            stored_path = ATTACH_DIR / stored_name
+            try:
+                with open(stored_path, "wb") as f:
+                    size_bytes = self._write_attachment_payload(part, f)
+                rename_mappings.append(
+                    {
+                        "id": attachment.id,
+                        "filename_stored": stored_name,
+                        "size_bytes": size_bytes,
+                    }
+                )
+            except Exception as e:
+                logger.exception("Erro ao salvar anexo: %s", e)
+                db.execute(
+                    delete(models.Attachment).where(models.Attachment.id == attachment.id)
+                )
+        if rename_mappings:
+            db.bulk_update_mappings(models.Attachment, rename_mappings)
 
     def fetch_and_store_emails( self, db: Session, dynamic_filters: Optional[Dict[str, Any]] = None, ) -> None:
         """ Lê emails do Gmail (via IMAP OAuth2), aplica filtros, salva emails/anexos, registra JobRun. """
@@ -68,9 +234,17 @@ class EmailFetchService:
                 return
 
             search_criteria = self._build_search_criteria(dynamic_filters)
-            logger.info("Busca IMAP com critérios: %s", search_criteria)
 
-            typ, data = imap.search(None, *search_criteria.split())
+            # Pré-filtro com os filtros cadastrados: FROM/SUBJECT vão para
+            # o SEARCH do servidor; a checagem completa (body_contains)
+            # continua em Python, sobre bem menos mensagens
+            db_filters = EmailFilterRepository.get_all(db, enabled_only=True)
+            pre_filter = _filters_to_imap_criteria(db_filters)
+            if pre_filter:
+                search_criteria = search_criteria + (pre_filter,)
+            logger.info("Busca IMAP com critérios: %s", " ".join(search_criteria))
+
+            typ, data = imap.search(None, *search_criteria)
             if typ != "OK":
                 logger.error("Erro ao buscar mensagens: %s - %s", typ, data)
                 JobRunRepository.finish(
@@ -88,22 +262,53 @@ class EmailFetchService:
             messages_fetched = len(message_nums)
             logger.info("Mensagens encontradas: %d", messages_fetched)
 
-            for num in message_nums:
-                typ, msg_data = imap.fetch(num, "(RFC822)")
-                if typ != "OK":
-                    logger.warning("Erro ao fazer fetch da mensagem %s: %s", num, typ)
+            # Primeiro passe: só o cabeçalho Message-ID (barato inclusive
+            # para o servidor), para decidir o que realmente precisa ter o
+            # corpo/anexos baixados. BytesHeaderParser para no fim dos
+            # cabeçalhos e nunca materializa corpo.
+            header_parser = BytesHeaderParser()
+            candidates = []  # (num, message_id)
+            for num, raw_header in self._fetch_raw_messages(
+                imap, message_nums, items="(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])"
+            ):
+                headers = header_parser.parsebytes(raw_header)
+                message_id = headers.get("Message-ID")
+                if not message_id:
+                    logger.warning("Mensagem sem Message-ID, ignorando.")
                     continue
+                candidates.append((num, message_id))
+
+            # Dedup em um único SELECT ... IN, em vez de uma consulta por
+            # mensagem.
+            existing = EmailRepository.existing_message_ids(
+                db, [mid for _, mid in candidates]
+            )
+            # Dedup também dentro do run: entregas duplicadas (ou cópias
+            # para si mesmo) compartilham o Message-ID e estourariam o
+            # UNIQUE no insert em lote — fica a primeira ocorrência
+            seen_mids = set()
+            new_nums = []
+            for num, mid in candidates:
+                if mid in existing or mid in seen_mids:
+                    continue
+                seen_mids.add(mid)
+                new_nums.append(num)
+
+            # Segundo passe: corpo completo apenas das mensagens novas,
+            # paralelizado em várias conexões quando vale a pena.
+            if len(new_nums) > 1 and settings.fetch_parallel_connections > 1:
+                raw_messages = self._fetch_bodies_parallel(new_nums)
+            else:
+                raw_messages = self._fetch_raw_messages(imap, new_nums)
+
+            emails_to_insert = []
+            attachments_pending = []  # (email_record, attachment, conteúdo)
 
-                raw_email = msg_data[0][1]
-                msg = email.message_from_bytes(raw_email)
+            for num, raw_email in raw_messages:
+                msg = email.message_from_bytes(raw_email, policy=email.policy.default)
 
                 message_id = msg.get("Message-ID")
                 if not message_id:
-                    logger.warning("Mensagem sem Message-ID, ignorando.")
-                    continue
-
-                if EmailRepository.get_by_message_id(db, message_id):
-                    logger.debug("Mensagem %s já existe. Ignorando.", message_id)
                     continue
 
                 from_ = msg.get("From")
@@ -112,40 +317,49 @@ class EmailFetchService:
                 subject_ = msg.get("Subject")
                 date_header = msg.get("Date")
 
-                # Extrair corpo texto
+                # Corpo texto: get_body faz a travessia com short-circuit
+                # (não visita anexos/alternativas além do necessário)
                 body_text = ""
-                if msg.is_multipart():
-                    for part in msg.walk():
-                        content_type = part.get_content_type()
-                        content_disposition = str(part.get("Content-Disposition") or "")
-
-                        if (
-                            content_type == "text/plain"
-                            and "attachment" not in content_disposition.lower()
-                        ):
-                            charset = part.get_content_charset() or "utf-8"
-                            payload = part.get_payload(decode=True)
-                            if payload:
-                                body_text += payload.decode(charset, errors="ignore")
-                else:
-                    charset = msg.get_content_charset() or "utf-8"
-                    payload = msg.get_payload(decode=True)
-                    if payload:
-                        body_text = payload.decode(charset, errors="ignore")
+                body_part = msg.get_body(preferencelist=("plain",))
+                if body_part is not None:
+                    try:
+                        body_text = body_part.get_content()
+                    except Exception:
+                        # charset desconhecido etc. — decodificação tolerante
+                        payload = body_part.get_payload(decode=True)
+                        if payload:
+                            charset = body_part.get_content_charset() or "utf-8"
+                            body_text = payload.decode(charset, errors="ignore")
+
+                # Checagem final em Python: o pré-filtro IMAP cobre só
+                # FROM/SUBJECT, então body_contains (e o AND completo de
+                # cada filtro) é decidido aqui
+                if db_filters and not apply_filters_to_email(
+                    {
+                        "sender": from_ or "",
+                        "subject": subject_ or "",
+                        "body": body_text,
+                    },
+                    db_filters,
+                ):
+                    continue
+
+                # iter_attachments pula as partes de texto direto
+                attachment_parts = (
+                    list(msg.iter_attachments()) if msg.is_multipart() else []
+                )
 
                 received_at = datetime.utcnow()
                 if date_header:
-                    try:
-                        from email.utils import parsedate_to_datetime
-
-                        received_at = parsedate_to_datetime(date_header)
-                    except Exception:
+                    parsed = parse_date_header(str(date_header))
+                    if parsed is not None:
+                        received_at = parsed
+                    else:
                         logger.debug(
                             "Não foi possível converter data do cabeçalho: %s", date_header
                         )
 
-                email_record = EmailRepository.create(
-                    db=db,
+                email_record = models.Email(
                     message_id=message_id,
                     sender=from_ or "",
                     recipient=to_,
@@ -154,47 +368,28 @@ class EmailFetchService:
                     body=body_text,
                     received_at=received_at,
                 )
-
-                # Anexos
-                for part in msg.walk():
-                    content_disposition = str(part.get("Content-Disposition") or "")
-                    if "attachment" in content_disposition.lower():
-                        filename = part.get_filename()
-                        if not filename:
-                            continue
-
-                        file_data = part.get_payload(decode=True) or b""
-                        mime_type = part.get_content_type()
-                        size_bytes = len(file_data)
-
-                        # Cria attachment com nome temporário
-                        temp_name = "PENDING"
-                        attachment = AttachmentRepository.create(
-                            db=db,
-                            email_id=email_record.id,
-                            filename_original=filename,
-                            filename_stored=temp_name,
-                            mime_type=mime_type,
-                            size_bytes=size_bytes,
-                        )
-
-                        stored_name = (
-                            f"ID{email_record.id:08d}-{attachment.id:08d}-{filename}"
-                        )
-                        stored_path = os.path.join(settings.attachments_dir, stored_name)
-
-                        try:
-                            with open(stored_path, "wb") as f:
-                                f.write(file_data)
-
-                            attachment.filename_stored = stored_name
-                            db.add(attachment)
-                        except Exception as e:
-                            logger.exception("Erro ao salvar anexo: %s", e)
-                            AttachmentRepository.delete(db, attachment)
-                            db.flush()
-
-                messages_saved += 1
+                emails_to_insert.append(email_record)
+
+                # Anexos: acumula metadata + a parte MIME ainda codificada;
+                # a decodificação acontece em blocos direto para o disco,
+                # depois do bulk insert, quando os PKs existem.
+                for part in attachment_parts:
+                    filename = part.get_filename()
+                    if not filename:
+                        continue
+
+                    attachment = models.Attachment(
+                        filename_original=filename,
+                        # placeholder único por linha (filename_stored tem
+                        # constraint UNIQUE); renomeado no _bulk_persist
+                        filename_stored=f"PENDING-{uuid.uuid4().hex}",
+                        mime_type=part.get_content_type(),
+                        size_bytes=None,  # preenchido após a gravação em disco
+                    )
+                    attachments_pending.append((email_record, attachment, part))
+
+            messages_saved = len(emails_to_insert)
+            self._bulk_persist(db, emails_to_insert, attachments_pending)
 
             JobRunRepository.finish(
                 db,
@@ -1,21 +1,46 @@
 # app/gmail_oauth_service.py
 import logging
 import imaplib
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from app.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Sessão HTTP compartilhada (keep-alive): mantém a conexão TLS com o
+# endpoint de token do Google aberta entre refreshes, com retry/backoff.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.3)),
+)
+
 
 class GmailOAuthService:
     """ Serviço responsável por: - Obter ACCESS_TOKEN a partir do REFRESH_TOKEN - Abrir conexão IMAP com Gmail via XOAUTH2 """
 
+    # Margem de segurança antes do token expirar (segundos)
+    TOKEN_EXPIRY_MARGIN = 60
+
     def __init__(self):
         self.settings = settings
+        self._token: str | None = None
+        self._token_expiry: float = 0.0
+        self._token_lock = threading.Lock()
 
     def get_access_token(self) -> str:
-        """ Usa o REFRESH_TOKEN para obter um ACCESS_TOKEN novo. """
+        """ Usa o REFRESH_TOKEN para obter um ACCESS_TOKEN novo. O token é cacheado até perto de expirar (~3600s), evitando um POST ao endpoint de token a cada conexão IMAP. """
+        with self._token_lock:
+            if self._token and time.monotonic() < self._token_expiry - self.TOKEN_EXPIRY_MARGIN:
+                return self._token
+            return self._refresh_access_token()
+
+    def _refresh_access_token(self) -> str:
         data = {
             "client_id": self.settings.gmail_client_id,
             "client_secret": self.settings.gmail_client_secret,
@@ -24,7 +49,7 @@ class GmailOAuthService:
         }
 
         token_url = self.settings.gmail_token_uri
-        resp = requests.post(token_url, data=data)
+        resp = _SESSION.post(token_url, data=data, timeout=10)
 
         if resp.status_code != 200:
             logger.error(
@@ -40,6 +65,10 @@ class GmailOAuthService:
             logger.error("Resposta do Google sem access_token: %s", payload)
             raise RuntimeError("access_token não encontrado na resposta do Google")
 
+        expires_in = payload.get("expires_in", 3600)
+        self._token = access_token
+        self._token_expiry = time.monotonic() + float(expires_in)
+
         return access_token
 
     def open_imap_connection(self) -> imaplib.IMAP4_SSL:
@@ -1,13 +1,21 @@
 import logging
 import logging.handlers
 import os
+import queue
 
 LOG_DIR = "logs"
 os.makedirs(LOG_DIR, exist_ok=True)
 LOG_FILE = os.path.join(LOG_DIR, "app.log")
 
+_listener: logging.handlers.QueueListener | None = None
+
 
 def configure_logging():
+    """ Configura o logging com QueueHandler: quem loga só enfileira (sem I/O no caminho quente), e um QueueListener em background escreve no console e no arquivo rotativo. """
+    global _listener
+    if _listener is not None:
+        return
+
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
@@ -18,8 +26,22 @@ def configure_logging():
 
     ch = logging.StreamHandler()
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
 
     fh = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=5_000_000, backupCount=5)
     fh.setFormatter(formatter)
-    logger.addHandler(fh)
\ No newline at end of file
+
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, ch, fh, respect_handler_level=True
+    )
+    _listener.start()
+
+
+def shutdown_logging():
+    """ Para o listener, drenando o que ainda estiver na fila. """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
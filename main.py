@@ -1,9 +1,11 @@
 from fastapi import FastAPI, Depends, HTTPException, status
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, HTMLResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from sqlalchemy.orm import Session
 
-from typing import Optional
+from datetime import datetime
+from typing import List, Optional
 
 from .database import Base, engine, get_db
 from .models import Email, Attachment
@@ -12,8 +14,11 @@ from .repositories import (
     AttachmentRepository,
     EmailFilterRepository,
 )
+from pydantic import TypeAdapter
+
 from .schemas import (
     EmailDetail,
+    EmailListItem,
     PaginatedEmails,
     EmailFilterCreate,
     EmailFilterUpdate,
@@ -23,14 +28,18 @@ from .schemas import (
 )
 from .services import get_job_metrics, run_email_check_job
 from .scheduler import start_scheduler, shutdown_scheduler
-from .logging_conf import configure_logging
+from .logging_conf import configure_logging, shutdown_logging
 from .config import settings
 
 import os
+from pathlib import Path
 
 # Configura logging
 configure_logging()
 
+# Diretório de anexos resolvido uma única vez no import
+ATTACH_DIR = Path(settings.attachments_dir)
+
 # Cria as tabelas
 Base.metadata.create_all(bind=engine)
 
@@ -38,6 +47,9 @@ app = FastAPI(
     title="Email Background Job API",
     description=""" API para gerenciamento de um job em segundo plano que verifica uma caixa de email a cada X minutos, filtra mensagens, armazena emails e anexos em SQLite/pasta local e fornece endpoints para gestão, métricas, filtros dinâmicos, download de anexos e interface web de controle. """,
     version="1.0.0",
+    # orjson serializa payloads grandes (datetime/listas) bem mais rápido
+    # que o json da stdlib
+    default_response_class=ORJSONResponse,
 )
 
 # Interface web
@@ -61,6 +73,7 @@ def on_startup():
 @app.on_event("shutdown")
 def on_shutdown():
     shutdown_scheduler()
+    shutdown_logging()
 
 
 # ---------- Métricas / Healthcheck ----------
@@ -78,9 +91,9 @@ def health():
 
 # ---------- Job manual ----------
 @app.post("/job/trigger", response_model=TriggerJobResponse, tags=["Job"])
-def trigger_job(db: Session = Depends(get_db)):
-    """ Executa o job de checagem de email imediatamente, sem aguardar o agendamento. """
-    job_run = run_email_check_job(db)
+async def trigger_job(db: Session = Depends(get_db)):
+    """ Executa o job de checagem de email imediatamente, sem aguardar o agendamento. O job (IMAP/HTTP bloqueantes) roda no threadpool para não travar o event loop. """
+    job_run = await run_in_threadpool(run_email_check_job, db)
     return TriggerJobResponse(
         job_run_id=job_run.id,
         status=job_run.status,
@@ -89,12 +102,65 @@ def trigger_job(db: Session = Depends(get_db)):
 
 
 # ---------- Emails ----------
+# Valida a página inteira de uma vez no core Rust do Pydantic, em vez de
+# uma conversão ORM -> modelo atributo a atributo por linha
+_EMAIL_LIST_ADAPTER = TypeAdapter(List[EmailListItem])
+
+
+def _encode_cursor(email: Email) -> str:
+    """ Serializa o par (received_at, id) do último item da página. """
+    ts = email.received_at.isoformat() if email.received_at else ""
+    return f"{ts}|{email.id}"
+
+
+def _decode_cursor(raw: str):
+    try:
+        ts_raw, id_raw = raw.rsplit("|", 1)
+        ts = datetime.fromisoformat(ts_raw) if ts_raw else None
+        return ts, int(id_raw)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="cursor inválido")
+
+
 @app.get("/emails", response_model=PaginatedEmails, tags=["Emails"])
-def list_emails( page: int = 1, page_size: int = 10, sender: Optional[str] = None, subject: Optional[str] = None, has_attachments: Optional[bool] = None, include_deleted: bool = False, db: Session = Depends(get_db), ):
-    """ Lista emails com paginação avançada e filtros opcionais via query params: - `page` / `page_size` - `sender` (contém) - `subject` (contém) - `has_attachments` (true/false) - `include_deleted` (inclui/exclui emails marcados como deletados) """
+def list_emails( page: int = 1, page_size: int = 10, cursor: Optional[str] = None, include_total: bool = True, sender: Optional[str] = None, subject: Optional[str] = None, has_attachments: Optional[bool] = None, include_deleted: bool = False, prefix_only: bool = False, db: Session = Depends(get_db), ):
+    """ Lista emails com paginação avançada e filtros opcionais via query params: - `page` / `page_size` - `cursor` (keyset: continua depois do último item da página anterior; custo constante em qualquer profundidade — prefira ao `page` para paginação profunda) - `include_total` (false pula a contagem total no modo cursor) - `sender` (contém) - `subject` (contém) - `prefix_only` (true trata sender/subject como prefixo, busca indexada) - `has_attachments` (true/false) - `include_deleted` (inclui/exclui emails marcados como deletados) """
     if page < 1 or page_size < 1:
         raise HTTPException(status_code=400, detail="page e page_size devem ser >= 1")
 
+    if cursor is not None:
+        rows = EmailRepository.get_paginated_keyset(
+            db=db,
+            cursor=_decode_cursor(cursor),
+            page_size=page_size,
+            sender=sender,
+            subject=subject,
+            has_attachments=has_attachments,
+            include_deleted=include_deleted,
+            prefix_only=prefix_only,
+        )
+        has_next = len(rows) > page_size
+        items = rows[:page_size]
+        total = None
+        if include_total:
+            total = EmailRepository.count(
+                db,
+                sender=sender,
+                subject=subject,
+                has_attachments=has_attachments,
+                include_deleted=include_deleted,
+                prefix_only=prefix_only,
+            )
+        return PaginatedEmails(
+            items=_EMAIL_LIST_ADAPTER.validate_python(items, from_attributes=True),
+            total=total,
+            page=page,
+            page_size=page_size,
+            has_next=has_next,
+            has_previous=True,  # um cursor sempre implica página anterior
+            next_cursor=_encode_cursor(items[-1]) if has_next else None,
+        )
+
     items, total = EmailRepository.get_paginated(
         db=db,
         page=page,
@@ -103,16 +169,18 @@ def list_emails( page: int = 1, page_size: int = 10, sender: Optional[str] = Non
         subject=subject,
         has_attachments=has_attachments,
         include_deleted=include_deleted,
+        prefix_only=prefix_only,
     )
     has_prev = page > 1
     has_next = (page * page_size) < total
     return PaginatedEmails(
-        items=items,
+        items=_EMAIL_LIST_ADAPTER.validate_python(items, from_attributes=True),
         total=total,
         page=page,
         page_size=page_size,
         has_next=has_next,
         has_previous=has_prev,
+        next_cursor=_encode_cursor(items[-1]) if has_next and items else None,
     )
 
 
@@ -149,13 +217,18 @@ def download_attachment(attachment_id: int, db: Session = Depends(get_db)):
     if not attachment:
         raise HTTPException(status_code=404, detail="Anexo não encontrado")
 
-    file_path = os.path.join(settings.attachments_dir, attachment.filename_stored)
-    if not os.path.exists(file_path):
+    file_path = ATTACH_DIR / attachment.filename_stored
+    # Um único stat(), reaproveitado pelo FileResponse (sem preflight
+    # os.path.exists redundante)
+    try:
+        stat_result = file_path.stat()
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Arquivo de anexo não encontrado em disco")
 
     filename = attachment.filename_original or "attachment"
     return FileResponse(
         path=file_path,
+        stat_result=stat_result,
         media_type=attachment.mime_type or "application/octet-stream",
         filename=filename,
     )
@@ -168,15 +241,14 @@ def delete_attachment(attachment_id: int, db: Session = Depends(get_db)):
     if not attachment:
         raise HTTPException(status_code=404, detail="Anexo não encontrado")
 
-    file_path = os.path.join(settings.attachments_dir, attachment.filename_stored)
+    file_path = ATTACH_DIR / attachment.filename_stored
     # Remove do DB
     AttachmentRepository.delete(db, attachment)
     db.commit()
 
-    # Remove do disco (se existir)
+    # Remove do disco (missing_ok evita o stat extra do exists)
     try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        file_path.unlink(missing_ok=True)
     except Exception:
         # Não quebra a API se falhar, mas poderia logar
         pass
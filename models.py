@@ -7,6 +7,8 @@ from sqlalchemy import (
     DateTime,
     ForeignKey,
     Boolean,
+    Index,
+    func,
 )
 from sqlalchemy.orm import relationship
 from .database import Base
@@ -28,6 +30,33 @@ class Email(Base):
 
     attachments = relationship("Attachment", back_populates="email", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Índice parcial casando exatamente o caminho quente da listagem:
+        # WHERE is_deleted = false ORDER BY received_at DESC, id DESC —
+        # o planner satisfaz OFFSET/LIMIT só com o índice, sem sort.
+        Index(
+            "ix_emails_active_received_id",
+            received_at.desc(),
+            id.desc(),
+            sqlite_where=is_deleted.is_(False),
+            postgresql_where=is_deleted.is_(False),
+        ),
+        # Índices funcionais para busca por prefixo (?prefix_only=true):
+        # lower(col) LIKE 'x%' é indexável, ao contrário do ILIKE '%x%'.
+        # Em PostgreSQL, text_pattern_ops habilita o uso do btree com
+        # LIKE mesmo sob locale != C.
+        Index(
+            "ix_emails_sender_lower",
+            func.lower(sender).label("sender_lower"),
+            postgresql_ops={"sender_lower": "text_pattern_ops"},
+        ),
+        Index(
+            "ix_emails_subject_lower",
+            func.lower(subject).label("subject_lower"),
+            postgresql_ops={"subject_lower": "text_pattern_ops"},
+        ),
+    )
+
 
 class Attachment(Base):
     __tablename__ = "attachments"
@@ -54,6 +83,9 @@ class EmailFilter(Base):
     subject_contains = Column(String(255), nullable=True)
     body_contains = Column(String(255), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False
+    )
 
 
 class JobRun(Base):
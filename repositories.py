@@ -1,18 +1,53 @@
 # app/repositories.py
 from typing import List, Optional, Tuple
-from datetime import datetime
 
-from sqlalchemy.orm import Session
-from sqlalchemy import select, func
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import and_, bindparam, or_, select, func
 
 from . import models
 
+# Statements quentes pré-construídos no nível do módulo: com bindparam a
+# chave do cache de compilação é estável e a construção do select() não
+# é paga a cada chamada.
+_SEL_EMAIL_BY_MSGID = select(models.Email).where(
+    models.Email.message_id == bindparam("mid")
+)
+_SEL_EMAIL_BY_ID = (
+    select(models.Email)
+    .options(selectinload(models.Email.attachments))
+    .where(models.Email.id == bindparam("eid"))
+)
+_SEL_ATTACHMENT_BY_ID = select(models.Attachment).where(
+    models.Attachment.id == bindparam("aid")
+)
+_SEL_FILTER_BY_ID = select(models.EmailFilter).where(
+    models.EmailFilter.id == bindparam("fid")
+)
+_SEL_LAST_JOB_RUN = (
+    select(models.JobRun).order_by(models.JobRun.id.desc()).limit(1)
+)
+
 
 class EmailRepository:
     @staticmethod
     def get_by_message_id(db: Session, message_id: str) -> Optional[models.Email]:
-        stmt = select(models.Email).where(models.Email.message_id == message_id)
-        return db.execute(stmt).scalars().first()
+        return db.execute(_SEL_EMAIL_BY_MSGID, {"mid": message_id}).scalars().first()
+
+    # Fatia dos INs de dedup, abaixo do limite de parâmetros do SQLite
+    MESSAGE_ID_CHUNK = 32000
+
+    @staticmethod
+    def existing_message_ids(db: Session, message_ids: List[str]) -> set:
+        """ Retorna o subconjunto de message_ids que já existem na base, em um SELECT por fatia de 32k ids (aproveita o índice único de message_id, sem materializar as linhas). """
+        found = set()
+        chunk_size = EmailRepository.MESSAGE_ID_CHUNK
+        for start in range(0, len(message_ids), chunk_size):
+            chunk = message_ids[start:start + chunk_size]
+            stmt = select(models.Email.message_id).where(
+                models.Email.message_id.in_(chunk)
+            )
+            found.update(db.execute(stmt).scalars())
+        return found
 
     @staticmethod
     def create( db: Session, message_id: str, sender: str, recipient: Optional[str], cc: Optional[str], subject: Optional[str], body: Optional[str], received_at, ) -> models.Email:
@@ -30,43 +65,147 @@ class EmailRepository:
         return email
 
     @staticmethod
-    def get_paginated( db: Session, page: int, page_size: int, sender: Optional[str] = None, subject: Optional[str] = None, has_attachments: Optional[bool] = None, include_deleted: bool = False, ) -> Tuple[List[models.Email], int]:
-        # SUGESTÃO: Para evitar duplicação de código, a construção da query
-        # poderia ser feita em uma função auxiliar.
+    def _build_query_filters( db: Session, sender: Optional[str], subject: Optional[str], has_attachments: Optional[bool], include_deleted: bool, prefix_only: bool = False, ) -> list:
+        """ Monta a lista de condições compartilhada entre as variantes de listagem (offset, keyset e contagem). """
         query_filters = []
         if not include_deleted:
             # Usar 'is_' para comparações com True/False/None é mais idiomático
             query_filters.append(models.Email.is_deleted.is_(False))
+
+        # Em PostgreSQL, busca textual via tsvector (match por token, usa o
+        # índice GIN; o ILIKE '%x%' força seq scan). Demais dialetos (SQLite)
+        # seguem com ILIKE. Índice esperado no deploy PG:
+        #   CREATE INDEX emails_sender_fts_idx ON emails
+        #       USING GIN (to_tsvector('simple', coalesce(sender, '')));
+        #   CREATE INDEX emails_subject_fts_idx ON emails
+        #       USING GIN (to_tsvector('simple', coalesce(subject, '')));
+        use_fts = db.get_bind().dialect.name == "postgresql"
         if sender:
-            query_filters.append(models.Email.sender.ilike(f"%{sender}%"))
+            if prefix_only:
+                # Busca por prefixo: lower(col) LIKE 'x%' casa os índices
+                # funcionais ix_emails_*_lower (text_pattern_ops no PG)
+                query_filters.append(
+                    func.lower(models.Email.sender).like(sender.lower() + "%")
+                )
+            elif use_fts:
+                query_filters.append(
+                    func.to_tsvector(
+                        "simple", func.coalesce(models.Email.sender, "")
+                    ).op("@@")(func.plainto_tsquery("simple", sender))
+                )
+            else:
+                query_filters.append(models.Email.sender.ilike(f"%{sender}%"))
         if subject:
-            query_filters.append(models.Email.subject.ilike(f"%{subject}%"))
+            if prefix_only:
+                query_filters.append(
+                    func.lower(models.Email.subject).like(subject.lower() + "%")
+                )
+            elif use_fts:
+                query_filters.append(
+                    func.to_tsvector(
+                        "simple", func.coalesce(models.Email.subject, "")
+                    ).op("@@")(func.plainto_tsquery("simple", subject))
+                )
+            else:
+                query_filters.append(models.Email.subject.ilike(f"%{subject}%"))
         if has_attachments is not None:
             if has_attachments:
                 query_filters.append(models.Email.attachments.any())
             else:
                 query_filters.append(~models.Email.attachments.any())
+        return query_filters
 
-        # Query para os itens paginados
-        stmt = select(models.Email).where(*query_filters)
-        
-        # Query para a contagem total, reutilizando os mesmos filtros
-        total_stmt = select(func.count(models.Email.id)).where(*query_filters)
-        
-        total = db.execute(total_stmt).scalar_one()
-        
-        stmt = stmt.order_by(
-            models.Email.received_at.desc().nullslast(),
-            models.Email.id.desc(),
-        ).offset((page - 1) * page_size).limit(page_size)
-        
-        items = db.execute(stmt).scalars().all()
+    @staticmethod
+    def get_paginated( db: Session, page: int, page_size: int, sender: Optional[str] = None, subject: Optional[str] = None, has_attachments: Optional[bool] = None, include_deleted: bool = False, prefix_only: bool = False, ) -> Tuple[List[models.Email], int]:
+        query_filters = EmailRepository._build_query_filters(
+            db, sender, subject, has_attachments, include_deleted, prefix_only
+        )
+
+        # Itens + contagem total em um único round-trip: count() OVER ()
+        # reaproveita o mesmo filtro sem uma query de COUNT separada.
+        # selectinload evita o N+1 de anexos na serialização (1 SELECT
+        # extra por página, não por email).
+        stmt = (
+            select(models.Email, func.count().over().label("total"))
+            .options(selectinload(models.Email.attachments))
+            .where(*query_filters)
+            .order_by(
+                models.Email.received_at.desc().nullslast(),
+                models.Email.id.desc(),
+            )
+            .offset((page - 1) * page_size)
+            .limit(page_size)
+        )
+        rows = db.execute(stmt).all()
+
+        if rows:
+            return [row[0] for row in rows], rows[0].total
+
+        # Página além do fim: a janela não retorna linhas, então a
+        # contagem precisa de uma query própria.
+        items: List[models.Email] = []
+        total = 0
+        if page > 1:
+            total = db.execute(
+                select(func.count(models.Email.id)).where(*query_filters)
+            ).scalar_one()
         return items, total
 
+    @staticmethod
+    def get_paginated_keyset( db: Session, cursor: Optional[Tuple[Optional[object], int]], page_size: int, sender: Optional[str] = None, subject: Optional[str] = None, has_attachments: Optional[bool] = None, include_deleted: bool = False, prefix_only: bool = False, ) -> List[models.Email]:
+        """ Paginação por keyset/seek: em vez de OFFSET (que varre e descarta N linhas nas páginas profundas), continua a partir do par (received_at, id) do último item da página anterior — custo O(page_size) em qualquer profundidade, casando o índice parcial de listagem. Retorna até page_size + 1 linhas; a extra sinaliza que há próxima página. """
+        query_filters = EmailRepository._build_query_filters(
+            db, sender, subject, has_attachments, include_deleted, prefix_only
+        )
+
+        if cursor is not None:
+            cursor_ts, cursor_id = cursor
+            if cursor_ts is None:
+                # Já estamos na cauda de received_at NULL (ordenada por id)
+                query_filters.append(
+                    and_(
+                        models.Email.received_at.is_(None),
+                        models.Email.id < cursor_id,
+                    )
+                )
+            else:
+                # Comparação lexicográfica explícita — tuple_() não lida
+                # com o NULLS LAST da ordenação
+                query_filters.append(
+                    or_(
+                        models.Email.received_at < cursor_ts,
+                        and_(
+                            models.Email.received_at == cursor_ts,
+                            models.Email.id < cursor_id,
+                        ),
+                        models.Email.received_at.is_(None),
+                    )
+                )
+
+        stmt = (
+            select(models.Email)
+            .options(selectinload(models.Email.attachments))
+            .where(*query_filters)
+            .order_by(
+                models.Email.received_at.desc().nullslast(),
+                models.Email.id.desc(),
+            )
+            .limit(page_size + 1)
+        )
+        return db.execute(stmt).scalars().all()
+
+    @staticmethod
+    def count( db: Session, sender: Optional[str] = None, subject: Optional[str] = None, has_attachments: Optional[bool] = None, include_deleted: bool = False, prefix_only: bool = False, ) -> int:
+        query_filters = EmailRepository._build_query_filters(
+            db, sender, subject, has_attachments, include_deleted, prefix_only
+        )
+        return db.execute(
+            select(func.count(models.Email.id)).where(*query_filters)
+        ).scalar_one()
+
     @staticmethod
     def get_by_id(db: Session, email_id: int) -> Optional[models.Email]:
-        stmt = select(models.Email).where(models.Email.id == email_id)
-        return db.execute(stmt).scalars().first()
+        return db.execute(_SEL_EMAIL_BY_ID, {"eid": email_id}).scalars().first()
 
     @staticmethod
     def soft_delete(db: Session, email: models.Email):
@@ -94,8 +233,11 @@ class AttachmentRepository:
 
     @staticmethod
     def get_by_id(db: Session, attachment_id: int) -> Optional[models.Attachment]:
-        stmt = select(models.Attachment).where(models.Attachment.id == attachment_id)
-        return db.execute(stmt).scalars().first()
+        return (
+            db.execute(_SEL_ATTACHMENT_BY_ID, {"aid": attachment_id})
+            .scalars()
+            .first()
+        )
 
     @staticmethod
     def delete(db: Session, attachment: models.Attachment):
@@ -120,8 +262,7 @@ class EmailFilterRepository:
 
     @staticmethod
     def get_by_id(db: Session, filter_id: int) -> Optional[models.EmailFilter]:
-        stmt = select(models.EmailFilter).where(models.EmailFilter.id == filter_id)
-        return db.execute(stmt).scalars().first()
+        return db.execute(_SEL_FILTER_BY_ID, {"fid": filter_id}).scalars().first()
 
     @staticmethod
     def delete(db: Session, filt: models.EmailFilter):
@@ -138,7 +279,9 @@ class JobRunRepository:
 
     @staticmethod
     def finish( db: Session, job_run: models.JobRun, messages_fetched: int, messages_saved: int, status: str, error_message: Optional[str] = None, ):
-        job_run.finished_at = datetime.utcnow()
+        # Timestamp do lado do servidor: o banco preenche no commit, sem
+        # depender do relógio do host
+        job_run.finished_at = func.now()
         job_run.messages_fetched = messages_fetched
         job_run.messages_saved = messages_saved
         job_run.status = status
@@ -147,16 +290,22 @@ class JobRunRepository:
 
     @staticmethod
     def get_last(db: Session) -> Optional[models.JobRun]:
-        stmt = select(models.JobRun).order_by(models.JobRun.id.desc()).limit(1)
-        return db.execute(stmt).scalars().first()
+        return db.execute(_SEL_LAST_JOB_RUN).scalars().first()
 
     @staticmethod
     def get_aggregated_metrics(db: Session):
-        total_fetched = db.execute(
-            select(func.coalesce(func.sum(models.JobRun.messages_fetched), 0))
-        ).scalar_one()
-        total_saved = db.execute(
-            select(func.coalesce(func.sum(models.JobRun.messages_saved), 0))
-        ).scalar_one()
-        last = JobRunRepository.get_last(db)
+        # Somas + id da última execução em um único round-trip; a linha
+        # completa vem depois por PK (busca pontual no índice)
+        total_fetched, total_saved, last_id = db.execute(
+            select(
+                func.coalesce(func.sum(models.JobRun.messages_fetched), 0),
+                func.coalesce(func.sum(models.JobRun.messages_saved), 0),
+                func.max(models.JobRun.id),
+            )
+        ).one()
+        last = None
+        if last_id is not None:
+            last = db.execute(
+                select(models.JobRun).where(models.JobRun.id == last_id)
+            ).scalars().first()
         return last, total_fetched, total_saved
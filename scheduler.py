@@ -1,5 +1,7 @@
 # app/scheduler.py
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
@@ -11,9 +13,13 @@ logger = logging.getLogger(__name__)
 
 _scheduler: AsyncIOScheduler | None = None
 
+# Executor dedicado de um worker: o IMAP/SQLAlchemy síncronos rodam aqui
+# em vez de bloquear o event loop que também atende a API
+_JOB_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="email-job")
 
-def _run_email_job():
-    """ Função que será executada pelo APScheduler: - Abre uma sessão de banco - Executa o serviço de fetch - Garante fechamento da sessão """
+
+def _do_fetch():
+    """ Corpo síncrono do job: - Abre uma sessão de banco - Executa o serviço de fetch - Garante fechamento da sessão """
     db = SessionLocal()
     try:
         gmail_oauth = GmailOAuthService()
@@ -25,6 +31,11 @@ def _run_email_job():
         db.close()
 
 
+async def _run_email_job():
+    """ Wrapper assíncrono executado pelo APScheduler: despacha o fetch bloqueante para o executor dedicado, mantendo o loop livre. """
+    await asyncio.get_running_loop().run_in_executor(_JOB_POOL, _do_fetch)
+
+
 def start_scheduler():
     global _scheduler
     if _scheduler is not None:
@@ -37,6 +48,11 @@ def start_scheduler():
         minutes=15,
         id="email_fetch_job",
         replace_existing=True,
+        # Sem sobreposição nem fila de atrasados: execuções perdidas
+        # dentro de 60s colapsam em uma só
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=60,
     )
     scheduler.start()
     _scheduler = scheduler
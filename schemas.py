@@ -1,6 +1,6 @@
 from datetime import datetime
 from typing import List, Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 # --------- Attachments ---------
@@ -13,25 +13,27 @@ class AttachmentBase(BaseModel):
     size_bytes: Optional[int] = None
     created_at: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 # --------- Emails ---------
-class EmailBase(BaseModel):
+class EmailListItem(BaseModel):
+    """ Item da listagem: todos os campos do email exceto o corpo — o body pode ter megabytes e dominaria a serialização da página. """
     id: int
     message_id: str
     sender: str
     recipient: Optional[str]
     cc: Optional[str]
     subject: Optional[str]
-    body: Optional[str]
     received_at: Optional[datetime]
     created_at: datetime
     is_deleted: bool
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+
+class EmailBase(EmailListItem):
+    body: Optional[str]
 
 
 class EmailDetail(EmailBase):
@@ -63,8 +65,7 @@ class EmailFilterOut(BaseModel):
     enabled: bool
     created_at: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 # --------- Job / Metrics ---------
@@ -84,14 +85,13 @@ class TriggerJobResponse(BaseModel):
 
 
 # --------- Pagination ---------
-class EmailListItem(EmailBase):
-    pass
-
-
 class PaginatedEmails(BaseModel):
     items: List[EmailListItem]
-    total: int
+    # total é None quando o cliente pagina por cursor com include_total=false
+    total: Optional[int] = None
     page: int
     page_size: int
     has_next: bool
-    has_previous: bool
\ No newline at end of file
+    has_previous: bool
+    # cursor opaco do último item da página; passe em ?cursor= para a próxima
+    next_cursor: Optional[str] = None
\ No newline at end of file
@@ -1,15 +1,17 @@
 import logging
 import os
-from typing import List, Optional, Dict, Any
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Dict, Any, Tuple
 
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
-from fastapi import HTTPException, status
 
 from .config import settings
 from .models import EmailFilter, Email, Attachment, JobRun
 from .repositories import (
-    EmailRepository,
-    AttachmentRepository,
     EmailFilterRepository,
     JobRunRepository,
 )
@@ -22,22 +24,133 @@ def ensure_attachments_dir():
     os.makedirs(settings.attachments_dir, exist_ok=True)
 
 
+# EmailClient é stateless entre execuções (conecta por fetch) — uma única
+# instância por processo, criada sob demanda.
+_EMAIL_CLIENT: Optional[EmailClient] = None
+
+
+def _get_email_client() -> EmailClient:
+    global _EMAIL_CLIENT
+    if _EMAIL_CLIENT is None:
+        _EMAIL_CLIENT = EmailClient()
+    return _EMAIL_CLIENT
+
+
+# Cache in-process dos filtros habilitados, validado por um probe barato
+# de (max(updated_at), count) — no caso comum (filtros inalterados) o
+# SELECT da lista inteira é pulado.
+_FILTERS_CACHE = {"stamp": None, "value": []}
+
+
+def get_enabled_filters(db: Session) -> List[EmailFilter]:
+    """ Retorna os filtros habilitados, reusando o cache quando o carimbo (max(updated_at), count) não mudou desde a última execução. """
+    stamp = tuple(
+        db.execute(
+            select(func.max(EmailFilter.updated_at), func.count(EmailFilter.id))
+        ).one()
+    )
+    if stamp == _FILTERS_CACHE["stamp"]:
+        return _FILTERS_CACHE["value"]
+
+    filters = EmailFilterRepository.get_all(db, enabled_only=True)
+    for f in filters:
+        # Desanexa da sessão para os valores continuarem acessíveis
+        # depois do commit/fechamento
+        db.expunge(f)
+    _FILTERS_CACHE["stamp"] = stamp
+    _FILTERS_CACHE["value"] = filters
+    return filters
+
+
 # ---------- Filtros Dinâmicos ----------
+class _CompiledFilters:
+    """ Estado pré-compilado dos filtros: needles minúsculos deduplicados por campo. Cada campo do email é minusculizado uma única vez e cada needle distinto varrido uma única vez (substring em C); o AND interno de cada filtro vira teste de pertinência em set — em vez de O(filtros × campos) lower() + in por email. """
+
+    _FIELD_MAP = (
+        ("sender", "from_address"),
+        ("subject", "subject_contains"),
+        ("body", "body_contains"),
+    )
+
+    def __init__(self, filters: List[EmailFilter]):
+        # Sem filtros cadastrados: aceita tudo (mesma semântica de
+        # apply_filters_to_email)
+        self.accept_all = not filters
+        self.rules = []  # lista de [(campo, needle), ...] por filtro
+        self.needles = {"sender": set(), "subject": set(), "body": set()}
+        for f in filters:
+            if not f.enabled:
+                continue
+            conds = []
+            for field, attr in self._FIELD_MAP:
+                value = getattr(f, attr)
+                if value:
+                    needle = value.lower()
+                    conds.append((field, needle))
+                    self.needles[field].add(needle)
+            # Filtro sem nenhuma condição configurada é ignorado
+            if conds:
+                self.rules.append(conds)
+
+    def matches(self, email_data: Dict[str, Any]) -> bool:
+        if self.accept_all:
+            return True
+        if not self.rules:
+            return False
+
+        lowered = {
+            field: (email_data.get(field) or "").lower()
+            for field in ("sender", "subject", "body")
+        }
+        hits = {
+            field: {n for n in needles if n in lowered[field]}
+            for field, needles in self.needles.items()
+        }
+        # OR entre filtros, AND entre as condições de cada filtro
+        return any(
+            all(needle in hits[field] for field, needle in conds)
+            for conds in self.rules
+        )
+
+
+# Estado compilado memoizado no módulo, chaveado pelo conteúdo dos
+# filtros: entre execuções com filtros inalterados (o caso comum) a
+# recompilação é pulada por completo
+_COMPILED_CACHE = {"key": None, "value": None}
+
+
+def _get_compiled_filters(filters: List[EmailFilter]) -> _CompiledFilters:
+    key = tuple(
+        (f.id, f.enabled, f.from_address, f.subject_contains, f.body_contains)
+        for f in filters
+    )
+    if key != _COMPILED_CACHE["key"]:
+        _COMPILED_CACHE["value"] = _CompiledFilters(filters)
+        _COMPILED_CACHE["key"] = key
+    return _COMPILED_CACHE["value"]
+
+
 def apply_filters_to_email(email_data: Dict[str, Any], filters: List[EmailFilter]) -> bool:
     """ Retorna True se o email passar em ALGUM filtro ativo (OR entre filtros), cada filtro internamente é AND entre seus campos configurados. """
     if not filters:
         return True  # se não há filtros, aceita todos
 
+    # Minusculiza cada campo uma única vez por email — dentro do loop o
+    # lower() era pago por filtro, e o corpo pode ter megabytes
+    sender_l = (email_data["sender"] or "").lower()
+    subject_l = (email_data["subject"] or "").lower()
+    body_l = (email_data["body"] or "").lower()
+
     for f in filters:
         if not f.enabled:
             continue
         conds = []
         if f.from_address:
-            conds.append(f.from_address.lower() in (email_data["sender"] or "").lower())
+            conds.append(f.from_address.lower() in sender_l)
         if f.subject_contains:
-            conds.append(f.subject_contains.lower() in (email_data["subject"] or "").lower())
+            conds.append(f.subject_contains.lower() in subject_l)
         if f.body_contains:
-            conds.append(f.body_contains.lower() in (email_data["body"] or "").lower())
+            conds.append(f.body_contains.lower() in body_l)
 
         # Se o filtro não tiver nenhuma condição configurada, ignora-o
         if not (f.from_address or f.subject_contains or f.body_contains):
@@ -63,51 +176,75 @@ def run_email_check_job(db: Session) -> JobRun:
 
     try:
         ensure_attachments_dir()
-        client = EmailClient()
-        raw_emails = client.fetch_unseen_emails_raw()
-        messages_fetched = len(raw_emails)
-
-        filters = EmailFilterRepository.get_all(db, enabled_only=True)
-
-        for em in raw_emails:
-            # Evitar duplicação por message_id
-            if not em["message_id"]:
-                # se não tem message_id, você pode criar um hash do corpo, mas por simplicidade vamos ignorar
-                continue
-            if EmailRepository.get_by_message_id(db, em["message_id"]):
-                continue
-
-            # aplicar filtros dinâmicos
-            if not apply_filters_to_email(em, filters):
-                continue
+        client = _get_email_client()
+
+        filters = get_enabled_filters(db)
+        compiled_filters = _get_compiled_filters(filters)
+
+        # Processamento em lotes: só um lote de corpos/anexos fica em
+        # memória por vez, e cada lote é commitado antes do próximo FETCH
+        for raw_chunk in client.iter_unseen_emails():
+            messages_fetched += len(raw_chunk)
+
+            email_rows = []
+            attachments_by_msg = {}  # message_id -> anexos crus
+
+            # Dedup fica por conta do banco: o INSERT ... ON CONFLICT
+            # (message_id) DO NOTHING descarta duplicatas atomicamente,
+            # sem SELECT prévio nem corrida entre jobs concorrentes
+            for em in raw_chunk:
+                if not em["message_id"]:
+                    # se não tem message_id, você pode criar um hash do corpo, mas por simplicidade vamos ignorar
+                    continue
+
+                # aplicar filtros dinâmicos (estado compilado uma vez por run)
+                if not compiled_filters.matches(em):
+                    continue
+
+                email_rows.append(
+                    {
+                        "message_id": em["message_id"],
+                        "sender": em["sender"],
+                        "recipient": em["recipient"],
+                        "cc": em["cc"],
+                        "subject": em["subject"],
+                        "body": em["body"],
+                        "received_at": em["received_at"],
+                    }
+                )
+                if em["attachments"]:
+                    attachments_by_msg[em["message_id"]] = em["attachments"]
 
-            # Cria Email
-            email_obj = EmailRepository.create(
-                db,
-                message_id=em["message_id"],
-                sender=em["sender"],
-                recipient=em["recipient"],
-                cc=em["cc"],
-                subject=em["subject"],
-                body=em["body"],
-                received_at=em["received_at"],
-            )
+            # Limpa temporários de mensagens descartadas (sem message_id,
+            # duplicadas ou reprovadas nos filtros)
+            for em in raw_chunk:
+                if em["attachments"] and em["message_id"] not in attachments_by_msg:
+                    for attach in em["attachments"]:
+                        _discard_attachment_tmp(attach)
 
-            # Anexos: regra de gravação com rollback se falhar
-            for attach in em["attachments"]:
-                _save_attachment_with_rollback(
-                    db=db,
-                    email_obj=email_obj,
-                    filename_original=attach["filename"],
-                    mime_type=attach["mime_type"],
-                    content=attach["content"],
-                    size_bytes=attach["size_bytes"],
+            try:
+                saved, pending_writes = _bulk_save_emails(
+                    db, email_rows, attachments_by_msg
+                )
+                messages_saved += saved
+            except Exception:
+                # Uma linha ruim não pode derrubar o lote inteiro: refaz
+                # email a email sob SAVEPOINTs, descartando só os culpados
+                logger.exception(
+                    "Falha no insert em lote; repetindo email a email"
+                )
+                db.rollback()
+                saved, pending_writes = _save_emails_one_by_one(
+                    db, email_rows, attachments_by_msg
                 )
+                messages_saved += saved
+            db.commit()
 
-            messages_saved += 1
+            # Escritas em disco fora da transação: o commit dos metadados
+            # não fica bloqueado pela latência de disco dos anexos
+            _flush_attachments_to_disk(db, pending_writes)
 
         status_str = "success"
-        db.commit()
     except Exception as exc:
         logger.exception("Erro ao executar job de checagem de e-mail")
         db.rollback()
@@ -129,56 +266,143 @@ def run_email_check_job(db: Session) -> JobRun:
     return job_run
 
 
-def _save_attachment_with_rollback( db: Session, email_obj: Email, filename_original: str, mime_type: Optional[str], content: bytes, size_bytes: Optional[int], ):
-    """ Regras: - primeiro grava metadata no DB (Attachment), com filename_stored provisório - flush para obter attachment.id - monta o nome final: 'ID<email_id>-<attachment_id>_<nome_original>' - atualiza attachment.filename_stored, tenta gravar arquivo em disco - se falhar ao gravar, faz rollback da transação e lança exceção """
+def _discard_attachment_tmp(attach: Dict[str, Any]):
+    """ Remove o arquivo temporário de um anexo que não será persistido. """
     try:
-        # Passo 1: cria registro com filename_stored temporário
-        temp_name = "temp"
-        attachment = AttachmentRepository.create(
-            db=db,
-            email_id=email_obj.id,
-            filename_original=filename_original,
-            filename_stored=temp_name,
-            mime_type=mime_type,
-            size_bytes=size_bytes,
+        os.unlink(attach["path"])
+    except OSError:
+        pass
+
+
+def _email_insert_stmt(db: Session):
+    """ INSERT de emails com dedup server-side quando o dialeto suporta: ON CONFLICT (message_id) DO NOTHING resolve a corrida entre jobs concorrentes atomicamente — duplicatas simplesmente não voltam no RETURNING. """
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = pg_insert(Email).on_conflict_do_nothing(
+            index_elements=["message_id"]
+        )
+    elif dialect == "sqlite":
+        stmt = sqlite_insert(Email).on_conflict_do_nothing(
+            index_elements=["message_id"]
+        )
+    else:
+        stmt = insert(Email)
+    return stmt.returning(Email.id, Email.message_id)
+
+
+def _bulk_save_emails( db: Session, email_rows: List[Dict[str, Any]], attachments_by_msg: Dict[str, List[Dict[str, Any]]], ) -> Tuple[int, List[Tuple[int, str, str]]]:
+    """ Persiste os emails aceitos em um único INSERT ... ON CONFLICT DO NOTHING ... RETURNING (insertmanyvalues), depois os anexos em outro, usando os PKs já atribuídos para o nome 'ID<email_id>-<attachment_id>_<nome_original>'. Duplicatas são descartadas pelo próprio banco. Nenhum I/O de disco acontece aqui: devolve (emails inseridos, renomeios pendentes (attachment_id, destino, temporário)) para depois do commit. """
+    if not email_rows:
+        return 0, []
+
+    result = db.execute(_email_insert_stmt(db), email_rows)
+    id_by_message = {message_id: email_id for email_id, message_id in result}
+    saved = len(id_by_message)
+
+    attachment_rows = []
+    tmp_paths = []
+    for message_id, attachments in attachments_by_msg.items():
+        email_id = id_by_message.get(message_id)
+        if email_id is None:
+            for attach in attachments:
+                _discard_attachment_tmp(attach)
+            continue
+        for attach in attachments:
+            attachment_rows.append(
+                {
+                    "email_id": email_id,
+                    "filename_original": attach["filename"],
+                    # placeholder único por linha (filename_stored tem
+                    # constraint UNIQUE); renomeado logo abaixo
+                    "filename_stored": f"PENDING-{uuid.uuid4().hex}",
+                    "mime_type": attach["mime_type"],
+                    "size_bytes": attach["size_bytes"],
+                }
+            )
+            tmp_paths.append(attach["path"])
+
+    if not attachment_rows:
+        return saved, []
+
+    # sort_by_parameter_order garante RETURNING na ordem das linhas de
+    # entrada, permitindo correlacionar id -> conteúdo por posição
+    result = db.execute(
+        insert(Attachment).returning(
+            Attachment.id, sort_by_parameter_order=True
+        ),
+        attachment_rows,
+    )
+    attachment_ids = [row[0] for row in result]
+
+    rename_mappings = []
+    pending_writes = []
+    for attachment_id, row, tmp_path in zip(attachment_ids, attachment_rows, tmp_paths):
+        stored_filename = (
+            f"ID{row['email_id']:08d}-{attachment_id:08d}_{row['filename_original']}"
+        )
+        rename_mappings.append(
+            {"id": attachment_id, "filename_stored": stored_filename}
+        )
+        pending_writes.append(
+            (
+                attachment_id,
+                os.path.join(settings.attachments_dir, stored_filename),
+                tmp_path,
+            )
         )
-        db.flush()  # attachment.id disponível
+    db.bulk_update_mappings(Attachment, rename_mappings)
+    return saved, pending_writes
 
-        stored_filename = f"ID{email_obj.id:08d}-{attachment.id:08d}_{filename_original}"
-        attachment.filename_stored = stored_filename
-        db.add(attachment)
-        db.flush()
 
-        # Passo 2: grava arquivo em disco
-        ensure_attachments_dir()
-        file_path = os.path.join(settings.attachments_dir, stored_filename)
+def _save_emails_one_by_one( db: Session, email_rows: List[Dict[str, Any]], attachments_by_msg: Dict[str, List[Dict[str, Any]]], ) -> Tuple[int, List[Tuple[int, str, str]]]:
+    """ Fallback do insert em lote: reinsere cada email dentro de um SAVEPOINT (begin_nested) — a linha que falhar é revertida sozinha e descartada, as demais seguem na transação externa. Retorna (emails salvos, renomeios pendentes de anexos). """
+    saved = 0
+    pending_writes = []
+    for row in email_rows:
+        attachments = attachments_by_msg.get(row["message_id"])
+        try:
+            with db.begin_nested():
+                row_saved, row_writes = _bulk_save_emails(
+                    db,
+                    [row],
+                    {row["message_id"]: attachments} if attachments else {},
+                )
+                pending_writes.extend(row_writes)
+            saved += row_saved
+        except Exception:
+            logger.exception(
+                "Descartando email %s após falha ao persistir", row["message_id"]
+            )
+            for attach in attachments or []:
+                _discard_attachment_tmp(attach)
+    return saved, pending_writes
 
+
+def _flush_attachments_to_disk( db: Session, pending_writes: List[Tuple[int, str, str]], max_workers: int = 8, ):
+    """ Materializa os anexos depois do commit: renomeio atômico do temporário para o nome final (mesmo filesystem), em paralelo. Falha em um arquivo gera a remoção compensatória apenas da linha de anexo correspondente, em uma transação curta própria. """
+    if not pending_writes:
+        return
+
+    def _finalize(item):
+        attachment_id, path, tmp_path = item
         try:
-            with open(file_path, "wb") as f:
-                f.write(content)
-        except Exception as exc:
-            logger.exception("Falha ao gravar arquivo de anexo em disco")
-            db.rollback()
-            # remover arquivo se parcialmente gravado
+            os.replace(tmp_path, path)
+            return None
+        except Exception:
+            logger.exception("Falha ao materializar anexo em disco: %s", path)
             try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except Exception:
+                os.unlink(tmp_path)
+            except OSError:
                 pass
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Erro ao salvar anexo '{filename_original}' em disco: {exc}",
-            )
+            return attachment_id
 
-    except HTTPException:
-        raise
-    except Exception as exc:
-        logger.exception("Erro ao salvar anexo com rollback")
-        db.rollback()
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Erro ao salvar anexo '{filename_original}': {exc}",
-        )
+    workers = min(max_workers, len(pending_writes))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        failed = [res for res in pool.map(_finalize, pending_writes) if res is not None]
+
+    if failed:
+        db.execute(delete(Attachment).where(Attachment.id.in_(failed)))
+        db.commit()
 
 
 # ---------- Métricas / Health ----------